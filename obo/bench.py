@@ -0,0 +1,180 @@
+from __future__ import absolute_import
+
+import sys
+import os
+import time
+import json
+import argparse
+import boto.s3.key
+import boto.s3.bucket
+import boto.s3.user
+
+from obo import obo
+
+# Microbenchmarks of client side code paths that run for every request or
+# every record. They run on synthetic data and need no server, results can
+# be saved and compared across commits. Each benchmark builds its fixtures
+# and returns the function that gets timed:
+#
+#   python -m obo.bench -o before.json
+#   python -m obo.bench --compare before.json
+
+
+def make_keys(n):
+    bucket = boto.s3.bucket.Bucket(name='bench')
+    owner = boto.s3.user.User(id='user', display_name='User')
+    keys = []
+    for i in xrange(n):
+        k = boto.s3.key.Key(bucket, 'dir{d}/object-{i:08d}'.format(d=i % 100, i=i))
+        k.size = i * 1024
+        k.etag = '"0123456789abcdef0123456789abcdef"'
+        k.last_modified = '2017-01-01T00:00:00.000Z'
+        k.owner = owner
+        k.storage_class = 'STANDARD'
+        k.metadata = { 'origin': 'bench' }
+        keys.append(k)
+    return keys
+
+def make_mdsearch_entries(n):
+    entries = []
+    for i in xrange(n):
+        entries.append({ 'Bucket': 'bench',
+                         'Key': 'object-{i:08d}'.format(i=i),
+                         'Instance': 'v{i}'.format(i=i),
+                         'ETag': '0123456789abcdef0123456789abcdef',
+                         'Owner': { 'ID': 'user', 'DisplayName': 'User' },
+                         'LastModified': '2017-01-01T00:00:00.000Z',
+                         'Size': i * 1024,
+                         'ContentType': 'application/octet-stream',
+                         'VersionedEpoch': i,
+                         'CustomMetadata': [{ 'Name': 'origin', 'Value': 'bench' }] })
+    return entries
+
+def bench_append_query_arg(n):
+    def op():
+        for i in xrange(n):
+            qa = obo.append_query_arg(None, 'rgwx-uid', 'user')
+            qa = obo.append_query_arg(qa, 'rgwx-version-id', 'v1')
+            qa = obo.append_query_arg(qa, 'rgwx-versioned-epoch', '10')
+            qa = obo.append_query_arg(qa, 'rgwx-source-zone', 'zone')
+            qa = obo.append_query_arg(qa, 'rgwx-client-id', 'client')
+            qa = obo.append_query_arg(qa, 'rgwx-op-id', 'op')
+            qa = obo.append_query_arg(qa, 'rgwx-copy-if-newer', True)
+    return op
+
+def bench_rgwx_query_args(n):
+    cmd = obo.OboCommand()
+    args = argparse.Namespace(rgwx_uid='user', rgwx_version_id='v1', rgwx_versioned_epoch='10',
+                              rgwx_source_zone='zone', rgwx_client_id='client', rgwx_op_id='op',
+                              rgwx_copy_if_newer=True)
+    def op():
+        for i in xrange(n):
+            cmd._get_rgwx_query_args(args)
+    return op
+
+def bench_get_attrs(n):
+    keys = make_keys(100)
+    attrs = ['name', 'size', 'last_modified', 'metadata', 'cache_control',
+             'content_type', 'content_disposition', 'content_language',
+             'owner', 'storage_class', 'md5', 'version_id', 'encrypted',
+             'delete_marker', 'expiry_date', 'VersionedEpoch', 'RgwxTag']
+    def op():
+        for i in xrange(n / 100):
+            for k in keys:
+                obo.get_attrs(k, attrs)
+    return op
+
+def bench_dump_json(n):
+    keys = make_keys(n)
+    def op():
+        obo.dump_json(keys)
+    return op
+
+def bench_to_record(n):
+    keys = make_keys(n)
+    def op():
+        for k in keys:
+            obo.to_record(k)
+    return op
+
+def bench_mdsearch_entries(n):
+    entries = make_mdsearch_entries(n)
+    def op():
+        l = [obo.mdsearch_entry_to_key(e) for e in entries]
+        l.sort(key = lambda l: (l.name, -l.versioned_epoch))
+    return op
+
+def bench_command_parse(n):
+    def op():
+        argv = sys.argv
+        env = dict(os.environ)
+        os.environ.update({ 'S3_ACCESS_KEY_ID': 'access', 'S3_SECRET_ACCESS_KEY': 'secret',
+                            'S3_HOSTNAME': 'localhost:8000' })
+        try:
+            sys.argv = ['obo', 'list', 'bench']
+            for i in xrange(n):
+                obo.OboCommand()._parse()
+        finally:
+            sys.argv = argv
+            os.environ.clear()
+            os.environ.update(env)
+    return op
+
+BENCHMARKS = [
+    ('append_query_arg', bench_append_query_arg, 100000),
+    ('rgwx_query_args', bench_rgwx_query_args, 100000),
+    ('get_attrs', bench_get_attrs, 100000),
+    ('dump_json', bench_dump_json, 10000),
+    ('to_record', bench_to_record, 10000),
+    ('mdsearch_entries', bench_mdsearch_entries, 10000),
+    ('command_parse', bench_command_parse, 1000),
+]
+
+def run(name, func, n, repeat):
+    # best of several runs, to reduce noise
+    best = None
+    for i in xrange(repeat):
+        op = func(n)
+        start = time.time()
+        op()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return { 'ops': n, 'time': best, 'usec_per_op': best * 1000000 / n }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run obo client side microbenchmarks',
+        usage='python -m obo.bench [<args>]')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale the number of ops per benchmark')
+    parser.add_argument('-o', '--out-file', help='Write results as json')
+    parser.add_argument('--compare', help='Compare to results previously written with --out-file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for (name, func, n) in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        r = run(name, func, max(1, int(n * args.scale)), args.repeat)
+        if baseline and name in baseline:
+            r['baseline_usec_per_op'] = baseline[name]['usec_per_op']
+            r['change'] = r['usec_per_op'] / baseline[name]['usec_per_op'] - 1
+        results[name] = r
+        line = '{name:20} {usec:12.3f} usec/op'.format(name=name, usec=r['usec_per_op'])
+        if 'change' in r:
+            line += ' {change:+8.1%}'.format(change=r['change'])
+        print line
+
+    if args.out_file:
+        with open(args.out_file, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,369 @@ import boto.s3.connection
 import argparse
 import json
 import urllib
+import threading
+import Queue
+import time
+import calendar
+import zlib
+import heapq
+import collections
+import itertools
+import types
+import mimetypes
+import hashlib
+import tempfile
+import fcntl
+import httplib
+import cProfile
+from StringIO import StringIO
 from boto.s3.key import Key
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import gevent.pool
+except ImportError:
+    gevent = None
+
 class OBOException:
     def __init__(self, message):
         self.message = message
 
+class TokenBucket:
+    def __init__(self, rate, burst = None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, n, now):
+        if n == 0:
+            return 0
+        self._refill(now)
+        # requests larger than the burst go through once the bucket is full,
+        # leaving it in debt
+        required = min(n, self.burst)
+        if self.tokens >= required:
+            return 0
+        return (required - self.tokens) / self.rate
+
+    def consume(self, n, now):
+        self._refill(now)
+        self.tokens -= n
+
+
+DATA_OP_TYPES = ['read', 'write', 'copy']
+OP_TYPES = DATA_OP_TYPES + ['list', 'head', 'delete', 'other']
+
+METADATA_SUBRESOURCES = set(['acl', 'cors', 'delete', 'lifecycle', 'location', 'mdsearch', 'policy',
+                             'tagging', 'uploads', 'versioning', 'versions', 'website'])
+
+def get_op_type(method, key, query_args, headers):
+    key = getattr(key, 'name', key)
+    if not key:
+        return 'list' if method == 'GET' else 'other'
+    if method == 'HEAD':
+        return 'head'
+    if method == 'DELETE':
+        return 'delete'
+    if query_args:
+        names = set(a.split('=', 1)[0] for a in query_args.split('&'))
+        if names & METADATA_SUBRESOURCES:
+            return 'other'
+    if method == 'GET':
+        return 'read'
+    if method == 'PUT':
+        if headers and 'x-amz-copy-source' in headers:
+            return 'copy'
+        return 'write'
+    return 'other'
+
+class OboTransferScheduler:
+    """
+    Client side rate limiting of requests. Every request waits for its turn:
+    metadata operations are served before data transfers, and requests of
+    the same class are served in arrival order.
+    """
+    def __init__(self, limits):
+        # limits: { op_type: (ops_per_sec, bytes_per_sec) }, None is the global limit
+        self.cond = threading.Condition()
+        self.waiters = []
+        self.seq = itertools.count()
+        self.ops_buckets = {}
+        self.bytes_buckets = {}
+        for op, (ops_rate, bytes_rate) in limits.iteritems():
+            if ops_rate:
+                self.ops_buckets[op] = TokenBucket(ops_rate)
+            if bytes_rate:
+                self.bytes_buckets[op] = TokenBucket(bytes_rate)
+        self.stats = {}
+
+    def _buckets(self, op):
+        return [(b, 1) for b in (self.ops_buckets.get(None), self.ops_buckets.get(op)) if b] + \
+               [(b, None) for b in (self.bytes_buckets.get(None), self.bytes_buckets.get(op)) if b]
+
+    def _get_stat(self, op):
+        stat = self.stats.get(op)
+        if not stat:
+            stat = { 'ops': 0, 'bytes': 0, 'queue_time': 0.0, 'max_queue_time': 0.0 }
+            self.stats[op] = stat
+        return stat
+
+    def acquire(self, op, size):
+        start = time.time()
+        priority = 1 if op in DATA_OP_TYPES else 0
+        ticket = (priority, next(self.seq))
+        buckets = self._buckets(op)
+
+        with self.cond:
+            heapq.heappush(self.waiters, ticket)
+            # a new arrival may take precedence over a sleeping head
+            self.cond.notify_all()
+            while True:
+                if self.waiters[0] != ticket:
+                    self.cond.wait()
+                    continue
+                now = time.time()
+                delay = max([b.delay(size if n is None else n, now) for (b, n) in buckets] + [0])
+                if delay <= 0:
+                    break
+                self.cond.wait(delay)
+
+            heapq.heappop(self.waiters)
+            for (b, n) in buckets:
+                b.consume(size if n is None else n, now)
+
+            queue_time = now - start
+            stat = self._get_stat(op)
+            stat['ops'] += 1
+            stat['bytes'] += size
+            stat['queue_time'] += queue_time
+            stat['max_queue_time'] = max(stat['max_queue_time'], queue_time)
+            self.cond.notify_all()
+
+    def charge(self, op, size):
+        # response sizes are only known after the fact, the debt delays later requests
+        with self.cond:
+            now = time.time()
+            for b in (self.bytes_buckets.get(None), self.bytes_buckets.get(op)):
+                if b:
+                    b.consume(size, now)
+            self._get_stat(op)['bytes'] += size
+
+    def get_stats(self):
+        with self.cond:
+            stats = {}
+            for op, stat in self.stats.iteritems():
+                d = dict(stat)
+                d['avg_queue_time'] = stat['queue_time'] / stat['ops'] if stat['ops'] else 0.0
+                stats[op] = d
+            return stats
+
+def get_scheduler_limits(env):
+    limits = {}
+    for op in [None] + OP_TYPES:
+        suffix = '_' + op.upper() if op else ''
+        ops_rate = env.get('S3_MAX_OPS_PER_SEC' + suffix)
+        bytes_rate = env.get('S3_MAX_BYTES_PER_SEC' + suffix)
+        if ops_rate or bytes_rate:
+            limits[op] = (float(ops_rate or 0), float(bytes_rate or 0))
+    return limits
+
+class OboEndpoint:
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.total_time = 0.0
+
+ENDPOINT_ERRORS = (socket.error, httplib.HTTPException, boto.exception.BotoServerError,
+                   boto.exception.PleaseRetryException)
+
+class OboEndpointBalancer:
+    """
+    Spreads requests over several endpoints, picking the one with the
+    fewest outstanding requests. Endpoints that fail repeatedly (connection
+    errors, 5xx responses) are ejected for a while, and requests that did
+    not send a body yet are retried on another endpoint. Requests that
+    stream their body through a sender cannot be replayed elsewhere, they
+    keep the connection's own retries on the endpoint they were sent to.
+    An endpoint counts a request as outstanding until its response is
+    closed, which httplib does once the body has been read.
+    """
+    def __init__(self, endpoints, fail_threshold = 3, eject_time = 30):
+        self.endpoints = endpoints
+        self.fail_threshold = fail_threshold
+        self.eject_time = eject_time
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def _acquire(self, exclude):
+        with self.lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e not in exclude and e.ejected_until <= now]
+            if not candidates:
+                # everything is ejected, try the one that comes back first
+                candidates = sorted([e for e in self.endpoints if e not in exclude],
+                                    key = lambda e: e.ejected_until)[:1]
+            # rotate the starting point so that ties are spread round robin
+            self.next = (self.next + 1) % len(self.endpoints)
+            n = len(candidates)
+            candidates = candidates[self.next % n:] + candidates[:self.next % n]
+            ep = min(candidates, key = lambda e: e.outstanding)
+            ep.outstanding += 1
+            ep.requests += 1
+            return ep
+
+    def _release(self, ep, start):
+        with self.lock:
+            ep.outstanding -= 1
+            ep.total_time += time.time() - start
+
+    def _track(self, ep, start, resp):
+        close = resp.close
+        released = []
+
+        def tracked_close():
+            close()
+            if not released:
+                released.append(True)
+                self._release(ep, start)
+
+        resp.close = tracked_close
+        if resp.isclosed():
+            tracked_close()
+
+    def _update_health(self, ep, success):
+        with self.lock:
+            if success:
+                ep.consecutive_failures = 0
+                return
+            ep.failures += 1
+            ep.consecutive_failures += 1
+            if ep.consecutive_failures >= self.fail_threshold:
+                ep.ejected_until = time.time() + self.eject_time
+                ep.ejections += 1
+                ep.consecutive_failures = 0
+
+    def make_request(self, *args, **kwargs):
+        sender = kwargs.get('sender') or (args[6] if len(args) > 6 else None)
+        if not sender and len(args) <= 7 and kwargs.get('override_num_retries') is None:
+            # failover is faster than retrying an endpoint that is down
+            kwargs['override_num_retries'] = 1
+        tried = set()
+        while True:
+            ep = self._acquire(tried)
+            start = time.time()
+            try:
+                resp = ep.conn.make_request(*args, **kwargs)
+            except ENDPOINT_ERRORS:
+                self._release(ep, start)
+                self._update_health(ep, False)
+                tried.add(ep)
+                if sender or len(tried) == len(self.endpoints):
+                    raise
+                continue
+            self._update_health(ep, resp.status < 500)
+            self._track(ep, start, resp)
+            return resp
+
+    def get_stats(self):
+        with self.lock:
+            now = time.time()
+            stats = {}
+            for e in self.endpoints:
+                stats[e.name] = { 'requests': e.requests,
+                                  'failures': e.failures,
+                                  'outstanding': e.outstanding,
+                                  'ejections': e.ejections,
+                                  'ejected': e.ejected_until > now,
+                                  'avg_time': e.total_time / e.requests if e.requests else 0.0 }
+            return stats
+
+def get_endpoints(env):
+    # S3_ENDPOINTS_FILE lists one endpoint per line, S3_HOSTNAME may hold a
+    # comma separated list
+    if env.get('S3_ENDPOINTS_FILE'):
+        with open(env['S3_ENDPOINTS_FILE']) as f:
+            endpoints = [l.split('#', 1)[0].strip() for l in f]
+    else:
+        endpoints = env['S3_HOSTNAME'].split(',')
+    endpoints = [e.strip() for e in endpoints if e.strip()]
+    if not endpoints:
+        raise OBOException('no endpoints configured')
+    return endpoints
+
+class OboS3Connection(boto.s3.connection.S3Connection):
+    scheduler = None
+    balancer = None
+
+    def _make_request(self, *args, **kwargs):
+        if self.balancer:
+            return self.balancer.make_request(*args, **kwargs)
+        return boto.s3.connection.S3Connection.make_request(self, *args, **kwargs)
+
+    def make_request(self, method, bucket='', key='', headers=None, data='', query_args=None, *args, **kwargs):
+        if not self.scheduler:
+            return self._make_request(method, bucket, key, headers, data, query_args, *args, **kwargs)
+
+        op = get_op_type(method, key, query_args, headers)
+        size = len(data or '')
+        if headers and 'Content-Length' in headers:
+            size = int(headers['Content-Length'])
+
+        self.scheduler.acquire(op, size)
+        resp = self._make_request(method, bucket, key, headers, data, query_args, *args, **kwargs)
+        if method == 'GET':
+            self.scheduler.charge(op, int(resp.getheader('content-length') or 0))
+        return resp
+
+
 class OBO:
-    def __init__(self, access_key, secret_key, host):
+    def __init__(self, access_key, secret_key, host, scheduler = None):
+        if isinstance(host, basestring):
+            host = host.split(',')
+
+        endpoints = [OboEndpoint(h, self._connect(access_key, secret_key, h)) for h in host]
+
+        if len(endpoints) == 1:
+            self.conn = endpoints[0].conn
+            self.balancer = None
+        else:
+            # requests are issued through the first connection, which hands
+            # them over to the endpoints; failover is done by the balancer
+            self.conn = self._connect(access_key, secret_key, host[0])
+            self.balancer = OboEndpointBalancer(endpoints)
+            self.conn.balancer = self.balancer
+
+        self.scheduler = scheduler
+        self.conn.scheduler = scheduler
+
+    def _connect(self, access_key, secret_key, host):
         host, port = (host.rsplit(':', 1) + [None])[:2]
         if port:
             port = int(port)
 
         is_secure = (port == 443)
 
-        self.conn = boto.connect_s3(
+        return OboS3Connection(
                 aws_access_key_id = access_key,
                 aws_secret_access_key = secret_key,
                 host=host,
@@ -33,6 +381,8 @@ class OBO:
         return self.conn.lookup(bucket_name)
 
     def make_request(self, method, bucket, key, query_args, headers):
+        # callers must read the result, the endpoint it came from counts it as
+        # outstanding until then
         result = self.conn.make_request(method, bucket=bucket, key=key, query_args=query_args, headers=headers)
         if result.status / 100 != 2:
             raise boto.exception.S3ResponseError(result.status, result.reason, result.read())
@@ -186,6 +536,568 @@ class BotoJSONEncoderListBucketVersioned(BotoJSONEncoder):
 def dump_json(o, cls=BotoJSONEncoder):
     return json.dumps(o, cls=cls, indent=4)
 
+def to_record(o, cls=BotoJSONEncoder):
+    # convert boto objects to plain dicts and lists, as they would be dumped
+    encoder = cls()
+
+    def convert(x):
+        if isinstance(x, dict):
+            return dict((k, convert(v)) for (k, v) in x.iteritems())
+        if isinstance(x, (list, tuple)):
+            return [convert(v) for v in x]
+        if x is None or isinstance(x, (basestring, bool, int, long, float)):
+            return x
+        return convert(encoder.default(x))
+
+    return convert(o)
+
+
+class OboWorkQueue:
+    def __init__(self, num_threads, max_pending = 0):
+        # a bounded queue throttles producers, do not bound it if tasks add tasks
+        self.queue = Queue.Queue(max_pending)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in xrange(max(num_threads, 1)):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            func, args = item
+            try:
+                func(*args)
+            except:
+                with self.lock:
+                    self.errors.append(sys.exc_info()[1])
+            self.queue.task_done()
+
+    def add(self, func, *args):
+        self.queue.put((func, args))
+
+    def wait(self):
+        # tasks may add more tasks, join() returns only once all of them are done
+        self.queue.join()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+
+def iter_results(tasks, num_threads):
+    # runs (func, args) tasks on a pool of threads and yields their
+    # non-None results as they complete
+    results = Queue.Queue()
+    errors = []
+
+    def run(func, args):
+        r = func(*args)
+        if r is not None:
+            results.put(r)
+
+    def feed():
+        try:
+            wq = OboWorkQueue(num_threads, max_pending=num_threads * 2)
+            for (func, args) in tasks:
+                wq.add(run, func, args)
+            wq.wait()
+        except:
+            errors.append(sys.exc_info()[1])
+        results.put(None)
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    while True:
+        r = results.get()
+        if r is None:
+            break
+        yield r
+
+    feeder.join()
+    if errors:
+        raise errors[0]
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+def parse_timestamp(s):
+    # S3 timestamps look like 2017-01-01T00:00:00.000Z, lifecycle dates may omit the time
+    s = s.rstrip('Z').split('.')[0]
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise OBOException('cannot parse timestamp: ' + s)
+
+def format_day(ts):
+    return time.strftime('%Y-%m-%d', time.gmtime(ts))
+
+class LifecycleActionEvaluator:
+    def __init__(self, days, date, now, window_days):
+        self.days = int(days) if days is not None else None
+        self.date = parse_timestamp(date) if date is not None else None
+        self.now = now
+        self.today = (now // SECONDS_PER_DAY) * SECONDS_PER_DAY
+        self.window_days = window_days
+        self.due_objects = 0
+        self.due_size = 0
+        self.upcoming_objects = numpy.zeros(window_days + 1, dtype=numpy.int64)
+        self.upcoming_size = numpy.zeros(window_days + 1, dtype=numpy.int64)
+
+    def evaluate(self, sizes, mtimes):
+        if self.days is not None:
+            # objects are due at the first midnight (UTC) after mtime + days
+            due = (mtimes // SECONDS_PER_DAY + self.days + 1) * SECONDS_PER_DAY
+        else:
+            due = numpy.empty_like(mtimes)
+            due.fill(self.date)
+
+        due_now = due <= self.now
+        self.due_objects += int(numpy.count_nonzero(due_now))
+        self.due_size += int(sizes[due_now].sum())
+
+        day = (due - self.today) // SECONDS_PER_DAY
+        upcoming = ~due_now & (day <= self.window_days)
+        day = day[upcoming]
+        self.upcoming_objects += numpy.bincount(day, minlength=self.window_days + 1)
+        self.upcoming_size += numpy.bincount(day, weights=sizes[upcoming],
+                                             minlength=self.window_days + 1).astype(numpy.int64)
+
+    def result(self):
+        d = {}
+        append_attr_value(d, 'days', self.days)
+        if self.date is not None:
+            d['date'] = format_day(self.date)
+        d['due'] = { 'objects': self.due_objects, 'size': self.due_size }
+        upcoming = []
+        for i in numpy.flatnonzero(self.upcoming_objects):
+            upcoming.append({ 'date': format_day(self.today + i * SECONDS_PER_DAY),
+                              'objects': int(self.upcoming_objects[i]),
+                              'size': int(self.upcoming_size[i]) })
+        d['upcoming'] = upcoming
+        return d
+
+class LifecycleRuleEvaluator:
+    def __init__(self, rule, proposed, now, window_days):
+        self.rule = rule
+        self.proposed = proposed
+        self.prefix = rule.prefix or ''
+        self.matched_objects = 0
+        self.matched_size = 0
+
+        self.expiration = None
+        self.transitions = []
+
+        # a disabled rule takes no action, only the objects it matches are reported
+        if rule.status == 'Disabled':
+            return
+
+        exp = rule.expiration
+        if exp is not None and (exp.days is not None or exp.date is not None):
+            self.expiration = LifecycleActionEvaluator(exp.days, exp.date, now, window_days)
+
+        transitions = rule.transition
+        if transitions is None:
+            transitions = []
+        elif isinstance(transitions, boto.s3.lifecycle.Transition):
+            transitions = [transitions]
+        for t in transitions:
+            if t.days is None and t.date is None:
+                continue
+            self.transitions.append((t.storage_class, LifecycleActionEvaluator(t.days, t.date, now, window_days)))
+
+    def evaluate(self, names, sizes, mtimes):
+        if self.prefix:
+            match = numpy.char.startswith(names, self.prefix)
+            sizes = sizes[match]
+            mtimes = mtimes[match]
+
+        if len(sizes) == 0:
+            return
+
+        self.matched_objects += len(sizes)
+        self.matched_size += int(sizes.sum())
+
+        if self.expiration:
+            self.expiration.evaluate(sizes, mtimes)
+        for (storage_class, t) in self.transitions:
+            t.evaluate(sizes, mtimes)
+
+    def result(self):
+        d = { 'prefix': self.prefix }
+        append_attr_value(d, 'id', self.rule.id)
+        append_attr_value(d, 'status', self.rule.status)
+        if self.proposed:
+            d['proposed'] = True
+        d['matched'] = { 'objects': self.matched_objects, 'size': self.matched_size }
+        if self.expiration:
+            d['expiration'] = self.expiration.result()
+        if self.transitions:
+            l = []
+            for (storage_class, t) in self.transitions:
+                r = t.result()
+                r['storage_class'] = storage_class
+                l.append(r)
+            d['transition'] = l
+        return d
+
+
+def walk_dir(top, prefix):
+    for (dirpath, dirnames, filenames) in os.walk(top):
+        dirnames.sort()
+        for f in sorted(filenames):
+            path = os.path.join(dirpath, f)
+            rel = os.path.relpath(path, top).replace(os.sep, '/')
+            yield (path, prefix + rel)
+
+def read_file_list(list_file, prefix):
+    for line in list_file:
+        path = line.rstrip('\n')
+        if not path:
+            continue
+        yield (path, prefix + path.lstrip('/'))
+
+COMPRESSION_TYPES = ['gzip', 'zstd']
+
+def get_compressor(encoding):
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise OBOException('zstd compression requires the zstandard module')
+        return zstandard.ZstdCompressor().compressobj()
+    raise OBOException('unsupported compression: ' + encoding)
+
+class OboDecompressor:
+    """
+    Decompresses a stream made of several concatenated gzip members or zstd
+    frames, a new decompressor is started on the data that follows the end
+    of each one.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.errors = (zlib.error,)
+        if encoding == 'zstd':
+            if zstandard is None:
+                raise OBOException('zstd decompression requires the zstandard module')
+            self.errors += (zstandard.ZstdError,)
+        self.d = self._new()
+        self.started = False
+
+    def _new(self):
+        if self.encoding == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        out = []
+        if data:
+            self.started = True
+        try:
+            while data:
+                if getattr(self.d, 'eof', False):
+                    self.d = self._new()
+                out.append(self.d.decompress(data))
+                data = getattr(self.d, 'unused_data', '')
+                if data:
+                    self.d = self._new()
+        except self.errors as e:
+            raise OBOException('failed to decompress %s data: %s' % (self.encoding, e))
+        return ''.join(out)
+
+    def _eof(self):
+        if hasattr(self.d, 'eof'):
+            return self.d.eof
+        if not hasattr(self.d, 'copy'):
+            return True
+        # python 2 zlib objects do not tell, but once a member is complete
+        # any further input is left in unused_data
+        probe = self.d.copy()
+        try:
+            probe.decompress('\0')
+        except self.errors:
+            return False
+        return probe.unused_data != ''
+
+    def flush(self):
+        if self.started and not self._eof():
+            raise OBOException('truncated %s data' % self.encoding)
+        if not hasattr(self.d, 'flush'):
+            return ''
+        try:
+            return self.d.flush()
+        except self.errors as e:
+            raise OBOException('failed to decompress %s data: %s' % (self.encoding, e))
+
+def get_decompressor(encoding):
+    if encoding in COMPRESSION_TYPES:
+        return OboDecompressor(encoding)
+    return None
+
+def read_compressed(infile, compressor, chunk_size = 1024 * 1024):
+    while True:
+        data = infile.read(chunk_size)
+        if not data:
+            break
+        data = compressor.compress(data)
+        if data:
+            yield data
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+PART_SIZE_AUTO = 'auto'
+MIN_PART_SIZE = 8 * 1024 * 1024
+MAX_PARTS = 10000
+MB = 1024 * 1024
+
+def part_size_arg(s):
+    if s == PART_SIZE_AUTO:
+        return s
+    return int(s)
+
+def get_auto_part_size(file_size):
+    part_size = max(MIN_PART_SIZE, (file_size + MAX_PARTS - 1) / MAX_PARTS)
+    return ((part_size + MB - 1) / MB) * MB
+
+class AdaptiveConcurrency:
+    """
+    Hill climbing on the number of requests in flight: after every window
+    of completed requests the measured throughput is compared to the
+    previous window, and the limit keeps moving in the same direction
+    while throughput improves.
+    """
+    def __init__(self, initial, maximum):
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.direction = 1
+        self.prev_throughput = None
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_count = 0
+
+    def update(self, size):
+        self.window_bytes += size
+        self.window_count += 1
+        if self.window_count < self.limit:
+            return
+
+        now = time.time()
+        throughput = self.window_bytes / max(now - self.window_start, 0.001)
+        if self.prev_throughput is not None:
+            if throughput < self.prev_throughput * 0.95:
+                self.direction = -self.direction or -1
+            elif throughput <= self.prev_throughput * 1.05:
+                self.direction = 0
+            elif self.direction == 0:
+                self.direction = 1
+        self.limit = max(1, min(self.maximum, self.limit + self.direction))
+        self.prev_throughput = throughput
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_count = 0
+
+
+class OboContentCache:
+    """
+    On-disk cache of object bodies, keyed by bucket, key and version. Each
+    entry is a data file and a json file holding its ETag; the json file
+    mtime tracks the last access for LRU eviction. Updates to the stats and
+    the set of entries are serialized across processes with a lock file.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _lock(self):
+        # the lock is released when the returned file is closed
+        f = open(os.path.join(self.cache_dir, 'lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _path(self, bucket_name, obj, version_id):
+        h = hashlib.sha1('\0'.join([bucket_name, obj, version_id or ''])).hexdigest()
+        return os.path.join(self.cache_dir, h)
+
+    def lookup(self, bucket_name, obj, version_id):
+        path = self._path(bucket_name, obj, version_id)
+        try:
+            with open(path + '.json') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(path + '.data'):
+            return None
+        entry['path'] = path
+        return entry
+
+    def touch(self, entry, validated = False):
+        if validated:
+            entry['validated'] = time.time()
+            self._write_entry(entry)
+        else:
+            os.utime(entry['path'] + '.json', None)
+
+    def _write_entry(self, entry):
+        path = entry['path']
+        d = dict(entry)
+        del d['path']
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(d, f)
+        os.rename(tmp, path + '.json')
+
+    def read(self, entry, chunk_size = 1024 * 1024):
+        with open(entry['path'] + '.data', 'rb') as f:
+            for data in iter(lambda: f.read(chunk_size), ''):
+                yield data
+
+    def store(self, bucket_name, obj, version_id, etag, content_encoding, chunks):
+        # passes the chunks through while writing them to the cache
+        path = self._path(bucket_name, obj, version_id)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp.')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in chunks:
+                    f.write(data)
+                    size += len(data)
+                    yield data
+        except:
+            os.unlink(tmp)
+            raise
+        with self._lock():
+            os.rename(tmp, path + '.data')
+            self._write_entry({ 'path': path, 'bucket': bucket_name, 'key': obj, 'version_id': version_id,
+                                'etag': etag, 'content_encoding': content_encoding, 'size': size,
+                                'validated': time.time() })
+            self._evict()
+
+    def evict(self):
+        with self._lock():
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, f[:-len('.json')])
+            try:
+                size = os.path.getsize(path + '.data')
+                atime = os.path.getmtime(path + '.json')
+            except OSError:
+                continue
+            entries.append((atime, size, path))
+            total += size
+
+        entries.sort()
+        for (atime, size, path) in entries:
+            if total <= self.max_size:
+                break
+            for suffix in ('.json', '.data'):
+                try:
+                    os.unlink(path + suffix)
+                except OSError:
+                    pass
+            total -= size
+
+    def update_stats(self, counter):
+        path = os.path.join(self.cache_dir, 'stats')
+        with self._lock():
+            try:
+                with open(path) as f:
+                    stats = json.load(f)
+            except (IOError, ValueError):
+                stats = { 'hits': 0, 'revalidated': 0, 'misses': 0 }
+            stats[counter] = stats.get(counter, 0) + 1
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(stats, f)
+            os.rename(tmp, path)
+        return stats
+
+
+def iter_listing(bucket, prefix, delimiter = None, versions = False, prefetch = 2):
+    # yields the current entries of a listing; following pages are fetched
+    # in the background while the current one is consumed
+    pages = Queue.Queue(prefetch)
+
+    def fetch():
+        try:
+            marker = key_marker = version_id_marker = ''
+            while True:
+                if versions:
+                    rs = bucket.get_all_versions(prefix=prefix, delimiter=delimiter,
+                                                 key_marker=key_marker, version_id_marker=version_id_marker)
+                else:
+                    rs = bucket.get_all_keys(prefix=prefix, delimiter=delimiter, marker=marker)
+                pages.put((rs, None))
+                if not rs.is_truncated or len(rs) == 0:
+                    break
+                if versions:
+                    key_marker = rs.next_key_marker
+                    version_id_marker = rs.next_version_id_marker
+                else:
+                    marker = rs.next_marker or rs[-1].name
+        except:
+            pages.put((None, sys.exc_info()[1]))
+            return
+        pages.put((None, None))
+
+    t = threading.Thread(target=fetch)
+    t.daemon = True
+    t.start()
+
+    while True:
+        (rs, error) = pages.get()
+        if error:
+            raise error
+        if rs is None:
+            return
+        if delimiter:
+            # boto keeps the XML order of a page, keys first and common prefixes
+            # after them; both runs are sorted, a stable sort merges them
+            rs = sorted(rs, key = lambda e: e.name)
+        for e in rs:
+            if versions and not isinstance(e, boto.s3.prefix.Prefix):
+                if not e.is_latest or isinstance(e, boto.s3.deletemarker.DeleteMarker):
+                    continue
+            yield e
+
+def merge_listings(a, a_prefix, b, b_prefix):
+    # merge-join of two sorted listings by name relative to their prefix
+    a_e = next(a, None)
+    b_e = next(b, None)
+    while a_e is not None or b_e is not None:
+        a_name = a_e.name[len(a_prefix):] if a_e is not None else None
+        b_name = b_e.name[len(b_prefix):] if b_e is not None else None
+        if b_e is None or (a_e is not None and a_name < b_name):
+            yield (a_name, a_e, None)
+            a_e = next(a, None)
+        elif a_e is None or b_name < a_name:
+            yield (b_name, None, b_e)
+            b_e = next(b, None)
+        else:
+            yield (a_name, a_e, b_e)
+            a_e = next(a, None)
+            b_e = next(b, None)
+
 
 class OboBucketStatus(json.JSONEncoder):
     def default(self, k):
@@ -206,16 +1118,96 @@ class OboBucket:
         if need_to_exist and not self.bucket:
             raise OBOException('bucket does not exist: ' + bucket_name)
 
-    def list_objects(self):
-        if (self.args.list_versions):
-            l = self.bucket.get_all_versions(prefix=self.args.prefix, delimiter=self.args.delimiter,
-                                        key_marker=self.args.key_marker, version_id_marker=self.args.version_id_marker,
-                                        max_keys=self.args.max_keys)
-            print dump_json(l, cls=BotoJSONEncoderListBucketVersioned)
-        else:
-            l = self.bucket.get_all_keys(prefix=self.args.prefix, delimiter=self.args.delimiter,
-                                        marker=self.args.marker, max_keys=self.args.max_keys)
-            print dump_json(l)
+    def list_objects(self, prefix=None, delimiter=None, marker=None, max_keys=None, versions=False,
+                     key_marker=None, version_id_marker=None, all_pages=False):
+        while True:
+            if versions:
+                l = self.bucket.get_all_versions(prefix=prefix, delimiter=delimiter,
+                                            key_marker=key_marker, version_id_marker=version_id_marker,
+                                            max_keys=max_keys)
+                for e in l:
+                    yield to_record(e, cls=BotoJSONEncoderListBucketVersioned)
+            else:
+                l = self.bucket.get_all_keys(prefix=prefix, delimiter=delimiter,
+                                            marker=marker, max_keys=max_keys)
+                for e in l:
+                    yield to_record(e)
+
+            if not all_pages or not l.is_truncated or len(l) == 0:
+                return
+
+            if versions:
+                key_marker = l.next_key_marker
+                version_id_marker = l.next_version_id_marker
+            else:
+                marker = l.next_marker or l[-1].name
+
+    def du(self, prefix, depth, delimiter, versioned, num_threads):
+        # only the reported prefixes are kept in memory, deeper prefixes are
+        # accounted into their closest reported ancestor
+        lock = threading.Lock()
+        stats = {}
+        parents = {}
+        levels = {}
+
+        def new_stat(p, parent, level):
+            with lock:
+                stats[p] = { 'objects': 0, 'size': 0 }
+                if versioned:
+                    stats[p]['delete_markers'] = 0
+                parents[p] = parent
+                levels[p] = level
+
+        def walk(p, report_prefix, level):
+            if versioned:
+                entries = self.bucket.list_versions(prefix=p, delimiter=delimiter)
+            else:
+                entries = self.bucket.list(prefix=p, delimiter=delimiter)
+
+            objects = 0
+            size = 0
+            delete_markers = 0
+
+            for e in entries:
+                if isinstance(e, boto.s3.prefix.Prefix):
+                    if level < depth:
+                        new_stat(e.name, report_prefix, level + 1)
+                        wq.add(walk, e.name, e.name, level + 1)
+                    else:
+                        wq.add(walk, e.name, report_prefix, level)
+                elif isinstance(e, boto.s3.deletemarker.DeleteMarker):
+                    delete_markers += 1
+                else:
+                    objects += 1
+                    size += e.size
+
+            with lock:
+                stat = stats[report_prefix]
+                stat['objects'] += objects
+                stat['size'] += size
+                if versioned:
+                    stat['delete_markers'] += delete_markers
+
+        wq = OboWorkQueue(num_threads)
+        new_stat(prefix, None, 0)
+        wq.add(walk, prefix, prefix, 0)
+        wq.wait()
+
+        # roll up totals, deepest prefixes first
+        for p in sorted(stats.keys(), key = lambda p: -levels[p]):
+            parent = parents[p]
+            if parent is None:
+                continue
+            for k, v in stats[p].iteritems():
+                stats[parent][k] += v
+
+        l = []
+        for p in sorted(stats.keys()):
+            d = { 'prefix': p }
+            d.update(stats[p])
+            l.append(d)
+
+        return l
 
     def create(self):
         try:
@@ -231,10 +1223,8 @@ class OboBucket:
 
     def stat(self, obj):
         if obj:
-            k = self.bucket.get_key(obj)
-            print dump_json(k)
-        else:
-            print json.dumps(self.bucket, cls=OboBucketStatus, indent=4)
+            return to_record(self.bucket.get_key(obj))
+        return to_record(self.bucket, cls=OboBucketStatus)
 
     def set_versioning(self, status, enable_mfa, mfa):
         bucket = self.obo.get_bucket(self.bucket_name)
@@ -246,7 +1236,7 @@ class OboBucket:
 
     def get_website(self):
         bucket = self.obo.get_bucket(self.bucket_name)
-        print dump_json(bucket.get_website_configuration_obj())
+        return to_record(bucket.get_website_configuration_obj())
 
     def configure_website(self, suffix, error_key, redirect_all_host, redirect_all_protocol,
             condition_key_prefix, condition_http_error_code, redirect_hostname, redirect_protocol,
@@ -274,10 +1264,8 @@ class OboBucket:
     def remove(self):
         self.obo.conn.delete_bucket(self.bucket_name)
 
-    def getacl(self, obj):
-        acl = self.bucket.get_acl(obj, version_id=self.args.version_id)
-        # TODO include a better format option for importing back
-        print acl
+    def getacl(self, obj, version_id = None):
+        return self.bucket.get_acl(obj, version_id=version_id)
 
     def get(self, obj):
         k = Key(self.bucket)
@@ -297,17 +1285,305 @@ class OboBucket:
         if self.args.date:
             headers['Date'] = self.args.date
 
-        k.get_contents_to_file(out, version_id=self.args.version_id, headers=headers)
-
-    def put(self, obj, meta_headers):
-        k = Key(self.bucket)
-        k.key = obj
+        cache = None
+        entry = None
+        if self.args.cache:
+            cache = OboContentCache(self.args.cache_dir, self.args.cache_size)
+            # a cached copy cannot answer the caller's own preconditions, the
+            # request goes to the server as is and only refreshes the cache
+            if not self.args.if_modified_since and not self.args.if_unmodified_since:
+                entry = cache.lookup(self.bucket_name, obj, self.args.version_id)
+
+        if not cache and self.args.read_ahead > 0:
+            self._get_read_ahead(obj, out, headers)
+            return
 
-        if not self.args.in_file:
-            infile = sys.stdin
+        stats = None
+        if entry and self.args.cache_ttl and time.time() - entry['validated'] < self.args.cache_ttl:
+            cache.touch(entry)
+            stats = cache.update_stats('hits')
+            self._write_body(cache.read(entry), out, entry['content_encoding'])
         else:
-            infile = open(self.args.in_file, 'rb')
+            if entry:
+                headers['If-None-Match'] = '"{e}"'.format(e=entry['etag'])
+
+            query_args = append_query_arg('', 'versionId', self.args.version_id)
+            try:
+                k.open_read(headers=headers, query_args=query_args)
+            except boto.exception.S3ResponseError as e:
+                if not entry or e.status != 304:
+                    raise
+                cache.touch(entry, validated=True)
+                stats = cache.update_stats('revalidated')
+                self._write_body(cache.read(entry), out, entry['content_encoding'])
+            else:
+                chunks = k
+                if cache and k.size <= self.args.cache_size:
+                    chunks = cache.store(self.bucket_name, obj, self.args.version_id,
+                                         k.etag[1:-1], k.content_encoding, k)
+                if cache:
+                    stats = cache.update_stats('misses')
+                self._write_body(chunks, out, k.content_encoding)
+
+        if stats and self.args.cache_stats:
+            sys.stderr.write(dump_json(stats) + '\n')
+
+    def _get_read_ahead(self, obj, out, headers):
+        # fetch up to read_ahead ranges concurrently, write them out in order
+        k = self.bucket.get_key(obj, headers=headers, version_id=self.args.version_id)
+        if not k:
+            raise OBOException('object does not exist: ' + obj)
+
+        range_size = self.args.range_size
+        depth = self.args.read_ahead
+        num_ranges = (k.size + range_size - 1) / range_size
+        cond = threading.Condition()
+        fetched = {}
+        errors = []
+
+        def fetch(i):
+            if errors:
+                return
+            h = dict(headers)
+            h['If-Match'] = k.etag
+            h['Range'] = 'bytes={s}-{e}'.format(s=i * range_size, e=min((i + 1) * range_size, k.size) - 1)
+            try:
+                data = Key(self.bucket, obj).get_contents_as_string(headers=h, version_id=self.args.version_id)
+            except:
+                with cond:
+                    errors.append(sys.exc_info()[1])
+                    cond.notify()
+                return
+            with cond:
+                fetched[i] = data
+                cond.notify()
+
+        def chunks():
+            # the range being written out plus depth ranges ahead of it
+            wq = OboWorkQueue(depth + 1)
+            next_fetch = 0
+            for i in xrange(num_ranges):
+                with cond:
+                    while not errors and next_fetch < min(i + 1 + depth, num_ranges):
+                        wq.add(fetch, next_fetch)
+                        next_fetch += 1
+                    while i not in fetched and not errors:
+                        cond.wait()
+                    if errors:
+                        raise errors[0]
+                    data = fetched.pop(i)
+                yield data
+            wq.wait()
+
+        self._write_body(chunks(), out, k.content_encoding)
+
+    def _write_body(self, chunks, out, content_encoding):
+        decompressor = None
+        if not self.args.no_decompress:
+            decompressor = get_decompressor(content_encoding)
+        for data in chunks:
+            if decompressor:
+                data = decompressor.decompress(data)
+            out.write(data)
+        if decompressor:
+            out.write(decompressor.flush())
+
+    def get_prefix(self, prefix, dest, part_size, num_threads, check_etag):
+        # keys map to paths relative to the last delimiter of the prefix
+        base = prefix[:prefix.rfind('/') + 1]
+        dest = os.path.abspath(dest)
+
+        def local_path(name):
+            path = os.path.normpath(os.path.join(dest, name[len(base):]))
+            if not path.startswith(dest + os.sep):
+                return None
+            return path
+
+        def is_current(path, k, mtime):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_size != k.size or int(st.st_mtime) != mtime:
+                return False
+            etag = k.etag[1:-1]
+            if not check_etag or '-' in etag:
+                return True
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(1024 * 1024), ''):
+                    md5.update(data)
+            return md5.hexdigest() == etag
+
+        def download_range(state, offset, size):
+            try:
+                if not state['error']:
+                    k = Key(self.bucket, state['key'].name)
+                    headers = { 'If-Match': state['key'].etag }
+                    if size != state['key'].size:
+                        headers['Range'] = 'bytes={s}-{e}'.format(s=offset, e=offset + size - 1)
+                    with open(state['tmp'], 'r+b') as f:
+                        f.seek(offset)
+                        k.get_contents_to_file(f, headers=headers)
+            except boto.exception.S3ResponseError as e:
+                state['error'] = { 'status': e.status, 'error_code': e.error_code }
+            except (IOError, OSError) as e:
+                state['error'] = str(e)
+
+            with state['lock']:
+                state['remaining'] -= 1
+                if state['remaining'] > 0:
+                    return None
+
+            # last range of the object, move it in place
+            r = state['result']
+            if not state['error']:
+                try:
+                    os.utime(state['tmp'], (state['mtime'], state['mtime']))
+                    os.rename(state['tmp'], r['file'])
+                except OSError as e:
+                    state['error'] = str(e)
+            if state['error']:
+                r['error'] = state['error']
+                try:
+                    os.unlink(state['tmp'])
+                except OSError:
+                    pass
+                return r
+            r['status'] = 'downloaded'
+            r['time'] = round(time.time() - state['start'], 6)
+            return r
+
+        def tasks():
+            for k in self.bucket.list(prefix=prefix):
+                if k.name.endswith('/'):
+                    continue
+                path = local_path(k.name)
+                mtime = parse_timestamp(k.last_modified)
+                r = { 'key': k.name, 'file': path, 'size': k.size }
+                if path is None:
+                    r['error'] = 'key maps outside of destination'
+                    yield (lambda r: r, (r,))
+                    continue
+                if is_current(path, k, mtime):
+                    r['status'] = 'skipped'
+                    yield (lambda r: r, (r,))
+                    continue
+
+                dirname = os.path.dirname(path)
+                try:
+                    if not os.path.isdir(dirname):
+                        try:
+                            os.makedirs(dirname)
+                        except OSError:
+                            if not os.path.isdir(dirname):
+                                raise
+
+                    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path) + '.')
+                    with os.fdopen(fd, 'wb') as f:
+                        f.truncate(k.size)
+                except (IOError, OSError) as e:
+                    r['error'] = str(e)
+                    yield (lambda r: r, (r,))
+                    continue
 
+                ranges = [(offset, min(part_size, k.size - offset)) for offset in xrange(0, k.size, part_size)] or [(0, 0)]
+                state = { 'key': k, 'tmp': tmp, 'mtime': mtime, 'result': r, 'error': None,
+                          'remaining': len(ranges), 'lock': threading.Lock(), 'start': time.time() }
+                for (offset, size) in ranges:
+                    yield (download_range, (state, offset, size))
+
+        return iter_results(tasks(), num_threads)
+
+    def _put_compressed(self, obj, infile, headers):
+        # compressed size is unknown upfront, so compressed output is buffered
+        # one part at a time and the upload switches to multipart once the
+        # first part fills up
+        part_size = self.args.part_size
+        auto = (part_size == PART_SIZE_AUTO)
+        if auto:
+            part_size = MIN_PART_SIZE
+        buf = StringIO()
+        mp = None
+        part_num = 1
+
+        for data in read_compressed(infile, get_compressor(self.args.compress)):
+            buf.write(data)
+            if buf.tell() < part_size:
+                continue
+            if not mp:
+                mp = self.bucket.initiate_multipart_upload(obj, headers=headers, policy=self.args.canned_acl)
+            buf.seek(0)
+            mp.upload_part_from_file(fp=buf, part_num=part_num)
+            part_num += 1
+            buf = StringIO()
+            # total size is unknown, grow the parts to stay within the parts limit
+            if auto and part_num % (MAX_PARTS / 10) == 0:
+                part_size *= 2
+
+        if not mp:
+            k = Key(self.bucket)
+            k.key = obj
+            k.set_contents_from_file(buf, policy=self.args.canned_acl, rewind=True, query_args=self.query_args,
+                 headers = headers)
+            return
+
+        if buf.tell() > 0:
+            buf.seek(0)
+            mp.upload_part_from_file(fp=buf, part_num=part_num)
+
+        mp.complete_upload()
+
+    def _put_multipart_adaptive(self, obj, infile, file_size, part_size, headers):
+        cond = threading.Condition()
+        control = AdaptiveConcurrency(2, self.args.max_concurrency)
+        state = { 'in_flight': 0 }
+
+        def upload_part(part_num, offset, size, data):
+            try:
+                if data is not None:
+                    fp = StringIO(data)
+                else:
+                    fp = open(self.args.in_file, 'rb')
+                    fp.seek(offset, os.SEEK_SET)
+                mp.upload_part_from_file(fp=fp, part_num=part_num, size=size)
+                fp.close()
+            finally:
+                with cond:
+                    state['in_flight'] -= 1
+                    control.update(size)
+                    cond.notify()
+
+        mp = self.bucket.initiate_multipart_upload(obj, headers=headers, policy=self.args.canned_acl)
+        wq = OboWorkQueue(self.args.max_concurrency)
+        try:
+            part_num = 1
+            for offset in xrange(0, file_size, part_size):
+                size = min(part_size, file_size - offset)
+                with cond:
+                    while state['in_flight'] >= control.limit and not wq.errors:
+                        cond.wait()
+                    if wq.errors:
+                        break
+                    state['in_flight'] += 1
+
+                # parts are read from a separate handle, unless input is stdin
+                data = None
+                if not self.args.in_file:
+                    infile.seek(offset, os.SEEK_SET)
+                    data = infile.read(size)
+
+                wq.add(upload_part, part_num, offset, size, data)
+                part_num += 1
+
+            wq.wait()
+        except:
+            mp.cancel_upload()
+            raise
+
+        mp.complete_upload()
+
+    def _get_put_headers(self, meta_headers):
         reduced_redundancy = False
         if self.args.storage_class == 'REDUCED_REDUNDANCY':
             reduced_redundancy = True
@@ -319,7 +1595,66 @@ class OboBucket:
         if self.args.storage_class is not None:
             headers['X-Amz-Storage-Class'] = self.args.storage_class
 
-        if self.args.multipart:
+        return headers, reduced_redundancy
+
+    def put_files(self, files, meta_headers, num_threads):
+        # all uploads share the bucket handle and the connection pool, so
+        # connections are kept alive across files
+        headers, reduced_redundancy = self._get_put_headers(meta_headers)
+
+        def upload(path, obj):
+            r = { 'file': path, 'key': obj }
+            start = time.time()
+            h = dict(headers)
+            if 'Content-Type' not in h:
+                content_type = mimetypes.guess_type(path)[0]
+                if content_type:
+                    h['Content-Type'] = content_type
+            try:
+                k = Key(self.bucket)
+                k.key = obj
+                with open(path, 'rb') as f:
+                    k.set_contents_from_file(f, policy=self.args.canned_acl, query_args=self.query_args,
+                         reduced_redundancy = reduced_redundancy, headers = h)
+                r['size'] = k.size
+                r['etag'] = k.etag[1:-1]
+            except boto.exception.S3ResponseError as e:
+                r['error'] = { 'status': e.status, 'error_code': e.error_code }
+            except (IOError, OSError) as e:
+                r['error'] = str(e)
+            r['time'] = round(time.time() - start, 6)
+            return r
+
+        return iter_results(((upload, f) for f in files), num_threads)
+
+    def put(self, obj, meta_headers):
+        k = Key(self.bucket)
+        k.key = obj
+
+        if not self.args.in_file:
+            infile = sys.stdin
+        else:
+            infile = open(self.args.in_file, 'rb')
+
+        headers, reduced_redundancy = self._get_put_headers(meta_headers)
+
+        if self.args.compress:
+            headers['Content-Encoding'] = self.args.compress
+            self._put_compressed(obj, infile, headers)
+
+        elif self.args.part_size == PART_SIZE_AUTO:
+            infile.seek(0, os.SEEK_END)
+            file_size = infile.tell()
+            infile.seek(0, os.SEEK_SET)
+
+            part_size = get_auto_part_size(file_size)
+            if file_size <= part_size:
+                k.set_contents_from_file(infile, policy=self.args.canned_acl, rewind=True, query_args=self.query_args,
+                     reduced_redundancy = reduced_redundancy, headers = headers)
+            else:
+                self._put_multipart_adaptive(obj, infile, file_size, part_size, headers)
+
+        elif self.args.multipart:
             part_num = 1
             part_size = self.args.part_size
 
@@ -345,7 +1680,7 @@ class OboBucket:
         except:
             loc = ''
 
-        print dump_json(loc)
+        return loc
 
     def get_lifecycle(self):
         try:
@@ -353,7 +1688,7 @@ class OboBucket:
         except:
             lc = boto.s3.lifecycle.Lifecycle()
 
-        print dump_json(lc)
+        return to_record(lc)
 
     def add_lifecycle(self, rule_id, prefix, status_bool, expiration, transition):
 
@@ -368,6 +1703,220 @@ class OboBucket:
 
         self.bucket.configure_lifecycle(lc)
 
+    def simulate_lifecycle(self, proposed_rule, batch_size, window_days):
+        if numpy is None:
+            raise OBOException('lifecycle simulation requires numpy')
+
+        try:
+            lc = self.bucket.get_lifecycle_config()
+        except:
+            lc = boto.s3.lifecycle.Lifecycle()
+
+        now = int(time.time())
+        evaluators = [LifecycleRuleEvaluator(r, False, now, window_days) for r in lc]
+        if proposed_rule is not None:
+            evaluators.append(LifecycleRuleEvaluator(proposed_rule, True, now, window_days))
+
+        if not evaluators:
+            return []
+
+        # no need to list keys that no rule can match
+        prefix = os.path.commonprefix([e.prefix for e in evaluators])
+
+        names = []
+        sizes = []
+        mtimes = []
+
+        def flush():
+            if not names:
+                return
+            names_col = numpy.array(names)
+            sizes_col = numpy.array(sizes, dtype=numpy.int64)
+            # listing timestamps look like 2017-01-01T00:00:00.000Z, the first
+            # 19 characters are parsed as UTC for the whole batch at once
+            try:
+                mtimes_col = numpy.array(mtimes, dtype='S19').astype('datetime64[s]').astype(numpy.int64)
+            except ValueError as e:
+                raise OBOException('cannot parse timestamp: ' + str(e))
+            for e in evaluators:
+                e.evaluate(names_col, sizes_col, mtimes_col)
+            del names[:]
+            del sizes[:]
+            del mtimes[:]
+
+        for k in self.bucket.list(prefix=prefix):
+            names.append(k.name)
+            sizes.append(k.size)
+            mtimes.append(k.last_modified)
+            if len(names) >= batch_size:
+                flush()
+
+        flush()
+
+        return [e.result() for e in evaluators]
+
+    def purge_versions(self, prefix='', keep=0, older_than=None, mfa=None, dry_run=False, batch_size=1000, num_threads=8,
+                       key_marker=None, version_id_marker=None, on_select=None):
+        # versions are listed newest first, so the selection is decided per key
+        # while streaming; only the current batch is held in memory
+        lock = threading.Lock()
+        summary = { 'versions': 0, 'delete_markers': 0, 'size': 0, 'errors': [] }
+
+        # version batches are numbered in submission order; a stale marker
+        # waits for the batch holding the last version of its key, and is
+        # dropped if a version of its key could not be deleted
+        failed_keys = set()
+        completed = set()
+        seq = { 'next': 0, 'done': 0 }
+        pending_markers = collections.deque()
+        marker_batch = []
+
+        def delete_batch(batch, batch_seq = None):
+            errors = []
+            try:
+                result = self.bucket.delete_keys(batch, quiet=True, mfa_token=mfa)
+                for e in result.errors:
+                    errors.append({ 'name': e.key, 'version_id': e.version_id,
+                                    'code': e.code, 'message': e.message })
+            except Exception as e:
+                for name, version_id in batch:
+                    errors.append({ 'name': name, 'version_id': version_id, 'message': str(e) })
+            with lock:
+                summary['errors'] += errors
+                if batch_seq is None:
+                    return
+                for e in errors:
+                    failed_keys.add(e['name'])
+                completed.add(batch_seq)
+                while seq['done'] in completed:
+                    completed.remove(seq['done'])
+                    seq['done'] += 1
+
+        def release_markers(flush = False):
+            with lock:
+                done = seq['done']
+                while pending_markers and (flush or pending_markers[0][2] < done):
+                    (name, version_id, dep) = pending_markers.popleft()
+                    if name in failed_keys:
+                        summary['delete_markers'] -= 1
+                    else:
+                        marker_batch.append((name, version_id))
+                    # later batches only hold keys that sort after this one
+                    for f in [f for f in failed_keys if f <= name]:
+                        failed_keys.remove(f)
+            while len(marker_batch) >= batch_size or (flush and marker_batch):
+                wq.add(delete_batch, marker_batch[:batch_size])
+                del marker_batch[:batch_size]
+
+        wq = None
+        if not dry_run:
+            wq = OboWorkQueue(num_threads, max_pending=num_threads * 2)
+
+        batch = []
+        key_seq = [-1]
+
+        def purge(k, stale=False):
+            if isinstance(k, boto.s3.deletemarker.DeleteMarker):
+                summary['delete_markers'] += 1
+            else:
+                summary['versions'] += 1
+                summary['size'] += k.size
+
+            if on_select:
+                on_select({ 'name': k.name, 'version_id': k.version_id,
+                            'delete_marker': isinstance(k, boto.s3.deletemarker.DeleteMarker) })
+
+            if dry_run:
+                return
+
+            # stale markers are removed once the versions behind them are gone
+            if stale:
+                pending_markers.append((k.name, k.version_id, key_seq[0]))
+                return
+
+            batch.append((k.name, k.version_id))
+            key_seq[0] = seq['next']
+            if len(batch) >= batch_size:
+                wq.add(delete_batch, batch[:], seq['next'])
+                seq['next'] += 1
+                del batch[:]
+                release_markers()
+
+        cur_name = None
+        noncurrent_since = None
+        num_noncurrent = 0
+        num_kept = 0
+        latest_marker = None
+
+        key_marker = key_marker or ''
+        version_id_marker = version_id_marker or ''
+
+        while True:
+            rs = self.bucket.get_all_versions(prefix=prefix, key_marker=key_marker,
+                                              version_id_marker=version_id_marker)
+            for k in rs:
+                if k.name != cur_name:
+                    # a delete marker is stale once no versions remain behind it
+                    if latest_marker is not None and num_kept == 0:
+                        purge(latest_marker, stale=True)
+                    if wq:
+                        release_markers()
+                    key_seq[0] = -1
+                    cur_name = k.name
+                    noncurrent_since = None
+                    num_noncurrent = 0
+                    num_kept = 0
+                    latest_marker = None
+
+                mtime = parse_timestamp(k.last_modified)
+
+                if k.is_latest:
+                    if isinstance(k, boto.s3.deletemarker.DeleteMarker):
+                        latest_marker = k
+                    noncurrent_since = mtime
+                    continue
+
+                # a version became noncurrent when its successor was created
+                since = noncurrent_since
+                noncurrent_since = mtime
+
+                if isinstance(k, boto.s3.deletemarker.DeleteMarker):
+                    purge(k)
+                    continue
+
+                # resuming in the middle of a key leaves the age of its first
+                # version unknown, keep it rather than guess
+                num_noncurrent += 1
+                if num_noncurrent <= keep or (older_than is not None and (since is None or since > older_than)):
+                    num_kept += 1
+                    continue
+
+                purge(k)
+
+            if not rs.is_truncated:
+                break
+            key_marker = rs.next_key_marker
+            version_id_marker = rs.next_version_id_marker
+
+        if latest_marker is not None and num_kept == 0:
+            purge(latest_marker, stale=True)
+
+        if batch:
+            wq.add(delete_batch, batch[:], seq['next'])
+
+        if wq:
+            wq.wait()
+
+            # every version batch is done, the remaining markers can go
+            wq = OboWorkQueue(num_threads, max_pending=num_threads * 2)
+            release_markers(flush=True)
+            wq.wait()
+
+        if dry_run:
+            summary['dry_run'] = True
+
+        return summary
+
     def remove_lifecycle(self, rule_id, remove_all):
 
         if remove_all:
@@ -393,11 +1942,11 @@ class OboBucket:
 
 
 class OboObject:
-    def __init__(self, obo, args, bucket_name, object_name, query_args = None):
+    def __init__(self, obo, args, bucket_name, object_name, query_args = None, bucket = None):
         self.obo = obo
         self.args = args
         self.bucket_name = bucket_name
-        self.bucket = obo.get_bucket(bucket_name)
+        self.bucket = bucket or obo.get_bucket(bucket_name)
         self.object_name = object_name
         self.query_args = query_args
 
@@ -411,7 +1960,7 @@ class OboObject:
         if mfa is not None:
             headers['x-amz-mfa'] = '{i} {t}'.format(i=mfa[0], t=mfa[1])
 
-        self.obo.make_request("DELETE", bucket=self.bucket.name, key=self.object_name, query_args=query_args, headers=headers)
+        self.obo.make_request("DELETE", bucket=self.bucket.name, key=self.object_name, query_args=query_args, headers=headers).read()
 
     def copy(self, source, version_id):
         src_str = '/{bucket}/{object}'.format(bucket=source[0], object=source[1])
@@ -424,7 +1973,7 @@ class OboObject:
         if self.args.storage_class is not None:
             headers['X-Amz-Storage-Class'] = self.args.storage_class
 
-        self.obo.make_request("PUT", bucket=self.bucket.name, key=self.object_name, query_args=self.query_args, headers=headers)
+        self.obo.make_request("PUT", bucket=self.bucket.name, key=self.object_name, query_args=self.query_args, headers=headers).read()
 
     def replace(self, source, version_id):
         src_str = '/{bucket}/{object}'.format(bucket=source[0], object=source[1])
@@ -454,7 +2003,248 @@ class OboObject:
 
         print 'headers=', headers
 
-        self.obo.make_request("PUT", bucket=self.bucket.name, key=self.object_name, query_args=self.query_args, headers=headers)
+        self.obo.make_request("PUT", bucket=self.bucket.name, key=self.object_name, query_args=self.query_args, headers=headers).read()
+
+RGWX_ARGS = ['rgwx_uid', 'rgwx_version_id', 'rgwx_versioned_epoch', 'rgwx_source_zone',
+             'rgwx_client_id', 'rgwx_op_id', 'rgwx_copy_if_newer']
+
+def get_latency_stats(latencies):
+    latencies.sort()
+    n = len(latencies)
+    pct = lambda p: latencies[min(n - 1, int(n * p))]
+    return { 'count': n,
+             'avg': sum(latencies) / n,
+             'p50': pct(0.5),
+             'p90': pct(0.9),
+             'p99': pct(0.99),
+             'max': latencies[-1] }
+
+class OboRgwxReplay:
+    """
+    Replays a log of copy, put and delete operations, one JSON object per
+    line, e.g.:
+
+      {"op": "copy", "bucket": "b", "key": "k", "source": "src/k", "rgwx_source_zone": "z1"}
+      {"op": "put", "bucket": "b", "key": "k", "size": 4096, "rgwx_op_id": "1"}
+      {"op": "delete", "bucket": "b", "key": "k", "version_id": "v1"}
+
+    Operations on the same key are executed in log order, others run
+    concurrently on a number of lanes.
+    """
+    def __init__(self, obo, args):
+        self.obo = obo
+        self.args = args
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.invalid = 0
+
+    def _get_bucket(self, name):
+        with self.lock:
+            b = self.buckets.get(name)
+            if not b:
+                b = self.obo.conn.get_bucket(name, validate=False)
+                self.buckets[name] = b
+            return b
+
+    def _op_args(self, entry):
+        # log entries fall back to the command line rgwx params
+        args = argparse.Namespace(storage_class=self.args.storage_class)
+        for a in RGWX_ARGS:
+            setattr(args, a, entry.get(a, getattr(self.args, a)))
+        for (k, v) in entry.iteritems():
+            setattr(args, k.replace('-', '_'), v)
+        return args
+
+    def _execute(self, entry, args, query_args):
+        op = entry['op']
+        bucket = self._get_bucket(entry['bucket'])
+        obj = OboObject(self.obo, args, bucket.name, entry['key'], query_args=query_args, bucket=bucket)
+        if op == 'copy':
+            obj.copy(entry['source'].split('/', 1), entry.get('version_id'))
+        elif op == 'delete':
+            obj.remove(entry.get('version_id'), entry.get('if_unmodified_since'))
+        elif op == 'put':
+            k = Key(bucket)
+            k.key = entry['key']
+            if entry.get('in_file'):
+                fp = open(entry['in_file'], 'rb')
+            else:
+                fp = StringIO('\0' * int(entry.get('size', 0)))
+            headers = {}
+            if args.storage_class is not None:
+                headers['X-Amz-Storage-Class'] = args.storage_class
+            k.set_contents_from_file(fp, query_args=query_args, headers=headers)
+            fp.close()
+        else:
+            raise OBOException('unknown replay op: ' + op)
+
+    def _run_lane(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            (entry, args, query_args) = item
+            op = entry.get('op')
+            start = time.time()
+            error = None
+            try:
+                self._execute(entry, args, query_args)
+            except boto.exception.S3ResponseError as e:
+                error = e.error_code or str(e.status)
+            except OBOException as e:
+                error = e.message
+            except Exception as e:
+                # an unexpected failure must not stop the lane
+                error = str(e) or e.__class__.__name__
+            latency = time.time() - start
+            with self.lock:
+                self.latencies.setdefault(op, []).append(latency)
+                if error:
+                    errors = self.errors.setdefault(op, {})
+                    errors[error] = errors.get(error, 0) + 1
+
+    def replay(self, log, rgwx_query_args, rate, num_lanes):
+        lanes = [Queue.Queue(64) for i in xrange(num_lanes)]
+        threads = []
+        for q in lanes:
+            t = threading.Thread(target=self._run_lane, args=(q,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        throttle = TokenBucket(rate, 1) if rate else None
+        start = time.time()
+
+        for (lineno, line) in enumerate(log, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                if not isinstance(entry, dict):
+                    raise ValueError('not a JSON object')
+                for field in ('op', 'bucket', 'key'):
+                    if field not in entry:
+                        raise ValueError('missing ' + field)
+            except ValueError as e:
+                sys.stderr.write(json.dumps({ 'line': lineno, 'error': str(e) }) + '\n')
+                self.invalid += 1
+                continue
+            args = self._op_args(entry)
+            query_args = rgwx_query_args(args)
+
+            if throttle:
+                now = time.time()
+                delay = throttle.delay(1, now)
+                if delay > 0:
+                    time.sleep(delay)
+                    now = time.time()
+                throttle.consume(1, now)
+
+            lane = hash((entry['bucket'], entry['key'])) % num_lanes
+            lanes[lane].put((entry, args, query_args))
+
+        for q in lanes:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+        elapsed = time.time() - start
+        total = sum(len(l) for l in self.latencies.itervalues())
+        ops = {}
+        for (op, l) in self.latencies.iteritems():
+            ops[op] = get_latency_stats(l)
+            if op in self.errors:
+                ops[op]['errors'] = self.errors[op]
+
+        return { 'ops': total,
+                 'elapsed': elapsed,
+                 'ops_per_sec': total / elapsed if elapsed > 0 else 0.0,
+                 'invalid_lines': self.invalid,
+                 'by_op': ops }
+
+
+DIFF_FIELDS = ['size', 'etag', 'version']
+
+class OboDiff:
+    def __init__(self, src, src_prefix, dst, dst_prefix, compare):
+        self.src = src
+        self.src_prefix = src_prefix
+        self.dst = dst
+        self.dst_prefix = dst_prefix
+        self.compare = compare
+        self.versions = 'version' in compare
+
+    def _entry(self, k):
+        d = { 'size': k.size, 'etag': k.etag[1:-1] }
+        if self.versions:
+            d['version_id'] = k.version_id
+        return d
+
+    def _compare(self, name, s, d):
+        if s is None:
+            return { 'key': name, 'status': 'missing_in_src', 'dst': self._entry(d) }
+        if d is None:
+            return { 'key': name, 'status': 'missing_in_dst', 'src': self._entry(s) }
+        diff = (('size' in self.compare and s.size != d.size) or
+                ('etag' in self.compare and s.etag != d.etag) or
+                ('version' in self.compare and s.version_id != d.version_id))
+        if not diff:
+            return None
+        return { 'key': name, 'status': 'different', 'src': self._entry(s), 'dst': self._entry(d) }
+
+    def _diff_prefix(self, name, delimiter = None):
+        src = iter_listing(self.src, self.src_prefix + name, delimiter, self.versions)
+        dst = iter_listing(self.dst, self.dst_prefix + name, delimiter, self.versions)
+        return merge_listings(src, self.src_prefix, dst, self.dst_prefix)
+
+    def diff(self, num_threads, delimiter):
+        if not delimiter or num_threads <= 1:
+            for (rel, s, d) in self._diff_prefix(''):
+                r = self._compare(rel, s, d)
+                if r:
+                    yield r
+            return
+
+        # every level is listed with a delimiter and each sub-prefix is walked
+        # as a separate task, results are streamed as they are found
+        results = Queue.Queue(1000)
+        errors = []
+
+        def walk(name):
+            for (rel, s, d) in self._diff_prefix(name, delimiter):
+                if isinstance(s or d, boto.s3.prefix.Prefix):
+                    wq.add(walk, rel)
+                    continue
+                r = self._compare(rel, s, d)
+                if r:
+                    results.put(r)
+
+        def wait():
+            try:
+                wq.wait()
+            except:
+                errors.append(sys.exc_info()[1])
+            results.put(None)
+
+        wq = OboWorkQueue(num_threads)
+        wq.add(walk, '')
+        waiter = threading.Thread(target=wait)
+        waiter.daemon = True
+        waiter.start()
+
+        while True:
+            r = results.get()
+            if r is None:
+                break
+            yield r
+
+        waiter.join()
+        if errors:
+            raise errors[0]
+
 
 def next_xml_entry(attr):
     if attr.text:
@@ -468,6 +2258,23 @@ def next_xml_entry(attr):
         return (attr.tag, None)
         #return [dict(next_xml_entry(x) for x in el) for el in attr.getchildren()]
 
+def mdsearch_entry_to_key(entry):
+    k = boto.s3.key.Key(boto.s3.bucket.Bucket(name=entry['Bucket']), entry['Key'])
+
+    k.version_id = entry['Instance']
+    k.etag = entry['ETag']
+    k.owner = entry['Owner']['ID']
+    k.last_modified = entry['LastModified']
+    k.size = entry['Size']
+    k.content_type = entry['ContentType']
+    k.versioned_epoch = entry['VersionedEpoch']
+
+    k.metadata = {}
+    for e in entry['CustomMetadata']:
+        k.metadata[e['Name']] = e['Value']
+
+    return k
+
 class OboMDSearch:
     def __init__(self, obo, args, bucket_name, query, query_args = None):
         self.obo = obo
@@ -475,18 +2282,18 @@ class OboMDSearch:
         self.bucket_name = bucket_name or ''
         self.query = query
         self.query_args = query_args
-        self.max_keys = args.max_keys
-        self.marker = args.marker
+        self.max_keys = getattr(args, 'max_keys', None)
+        self.marker = getattr(args, 'marker', None)
 
-    def config(self, conf):
+    def config(self, conf, delete = False):
         query_args = 'mdsearch'
         headers = { 'X-Amz-Meta-Search': conf }
-        if self.args.delete:
+        if delete:
             method = 'DELETE'
         else:
             method = 'POST'
 
-        self.obo.make_request(method, bucket=self.bucket_name, key='', query_args=query_args, headers=headers)
+        self.obo.make_request(method, bucket=self.bucket_name, key='', query_args=query_args, headers=headers).read()
 
     def show(self):
         query_args = 'mdsearch'
@@ -495,11 +2302,7 @@ class OboMDSearch:
 
         result = self.obo.make_request('GET', bucket=self.bucket_name, key='', query_args=query_args, headers=None)
 
-        s = result.read()
-
-        print s
-        print dump_json(json.loads(s))
-
+        return json.loads(result.read())
 
     def search(self):
         q = self.query or ''
@@ -514,33 +2317,17 @@ class OboMDSearch:
         headers = {}
 
         result = self.obo.make_request("GET", bucket=self.bucket_name, key='', query_args=query_args, headers=headers)
-        s = result.read()
-        print dump_json(json.loads(s))
-
-        result = json.loads(s)
+        result = json.loads(result.read())
 
         l = []
 
         for entry in result['Objects']:
-            k = boto.s3.key.Key(boto.s3.bucket.Bucket(name=entry['Bucket']), entry['Key'])
-
-            k.version_id = entry['Instance']
-            k.etag = entry['ETag']
-            k.owner = entry['Owner']['ID']
-            k.last_modified = entry['LastModified']
-            k.size = entry['Size']
-            k.content_type = entry['ContentType']
-            k.versioned_epoch = entry['VersionedEpoch']
-
-            k.metadata = {}
-            for e in entry['CustomMetadata']:
-                k.metadata[e['Name']] = e['Value']
-
-            l.append(k)
+            l.append(mdsearch_entry_to_key(entry))
 
         l.sort(key = lambda l: (l.name, -l.versioned_epoch))
 
-        print dump_json(l)
+        for k in l:
+            yield to_record(k)
 
 
 class OboService:
@@ -549,7 +2336,92 @@ class OboService:
         self.args = args
 
     def list_buckets(self):
-        print dump_json(self.obo.conn.get_all_buckets())
+        for b in self.obo.conn.get_all_buckets():
+            yield to_record(b)
+
+
+class OboClient:
+    """
+    Programmatic interface to obo. Operations return records (plain dicts
+    and lists, as the command line tool would print them) instead of
+    printing them; listings are returned as generators.
+    """
+    def __init__(self, access_key, secret_key, host, scheduler = None):
+        self.obo = OBO(access_key, secret_key, host, scheduler=scheduler)
+
+    def _bucket(self, bucket_name):
+        return OboBucket(self.obo, None, bucket_name, True)
+
+    def list_buckets(self):
+        return OboService(self.obo, None).list_buckets()
+
+    def list_objects(self, bucket_name, **kwargs):
+        return self._bucket(bucket_name).list_objects(**kwargs)
+
+    def stat(self, bucket_name, obj = None):
+        return self._bucket(bucket_name).stat(obj)
+
+    def get_acl(self, bucket_name, obj = '', version_id = None):
+        return self._bucket(bucket_name).getacl(obj, version_id)
+
+    def get_location(self, bucket_name):
+        return self._bucket(bucket_name).get_location()
+
+    def get_lifecycle(self, bucket_name):
+        return self._bucket(bucket_name).get_lifecycle()
+
+    def get_website(self, bucket_name):
+        return self._bucket(bucket_name).get_website()
+
+    def du(self, bucket_name, prefix = '', depth = 0, delimiter = '/', versioned = False, num_threads = 16):
+        return self._bucket(bucket_name).du(prefix, depth, delimiter, versioned, num_threads)
+
+    def simulate_lifecycle(self, bucket_name, proposed_rule = None, batch_size = 100000, window_days = 30):
+        return self._bucket(bucket_name).simulate_lifecycle(proposed_rule, batch_size, window_days)
+
+    def purge_versions(self, bucket_name, **kwargs):
+        return self._bucket(bucket_name).purge_versions(**kwargs)
+
+    def search(self, bucket_name, query, max_keys = None, marker = None):
+        s = OboMDSearch(self.obo, None, bucket_name, query)
+        s.max_keys = max_keys
+        s.marker = marker
+        return s.search()
+
+    def get_search_config(self, bucket_name):
+        return OboMDSearch(self.obo, None, bucket_name, None).show()
+
+
+class OboAsyncClient:
+    """
+    Concurrent variant of OboClient, based on gevent. Every operation is
+    spawned on a pool and returns a greenlet, its result is available
+    through get(). Listings are collected into lists. The caller needs to
+    call gevent.monkey.patch_all() before boto is imported for requests to
+    run concurrently.
+    """
+    def __init__(self, client, pool_size = 1000):
+        if gevent is None:
+            raise OBOException('async client requires gevent')
+        self.client = client
+        self.pool = gevent.pool.Pool(pool_size)
+
+    def __getattr__(self, name):
+        func = getattr(self.client, name)
+
+        def run(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+
+        def spawn(*args, **kwargs):
+            return self.pool.spawn(run, *args, **kwargs)
+
+        return spawn
+
+    def join(self):
+        self.pool.join()
 
 class OboBucketLocationCommand:
     def __init__(self, obo, args):
@@ -578,7 +2450,7 @@ class OboBucketLocationCommand:
         parser.add_argument('bucket_name')
         args = parser.parse_args(self.args[1:])
 
-        OboBucket(self.obo, args, args.bucket_name, True).get_location()
+        print dump_json(OboBucket(self.obo, args, args.bucket_name, True).get_location())
 
 class OboBucketLifecycleCommand:
     def __init__(self, obo, args):
@@ -588,7 +2460,7 @@ class OboBucketLifecycleCommand:
     def parse(self):
         parser = argparse.ArgumentParser(
             description='S3 control tool',
-            usage='obo bucket lifecycle [add | remove | get] <bucket> [<args>]')
+            usage='obo bucket lifecycle [add | remove | get | simulate] <bucket> [<args>]')
         parser.add_argument('subcommand', help='Subcommand to run')
         # parse_args defaults to [1:] for args, but you need to
         # exclude the rest of the args too, or validation will fail
@@ -607,13 +2479,9 @@ class OboBucketLifecycleCommand:
         parser.add_argument('bucket_name')
         args = parser.parse_args(self.args[1:])
 
-        OboBucket(self.obo, args, args.bucket_name, True).get_lifecycle()
+        print dump_json(OboBucket(self.obo, args, args.bucket_name, True).get_lifecycle())
 
-    def add(self):
-        parser = argparse.ArgumentParser(
-            description='Add bucket lifecycle configuration',
-            usage='obo bucket lifecycle add <bucket>')
-        parser.add_argument('bucket_name')
+    def _add_rule_parser_args(self, parser):
         parser.add_argument('--id')
         parser.add_argument('--prefix')
         parser.add_argument('--enable', action='store_true')
@@ -623,18 +2491,50 @@ class OboBucketLifecycleCommand:
         parser.add_argument('--transition-days')
         parser.add_argument('--transition-date')
         parser.add_argument('--transition-storage-class')
-        args = parser.parse_args(self.args[1:])
 
-        assert args.enable != args.disable
+    def _get_rule_expiration(self, args):
+        return boto.s3.lifecycle.Expiration(args.expiration_days, args.expiration_date)
 
-        expiration = boto.s3.lifecycle.Expiration(args.expiration_days, args.expiration_date)
+    def _get_rule_transition(self, args):
         transition = None
         if args.transition_storage_class:
             transition = boto.s3.lifecycle.Transition(args.transition_days, args.transition_date, args.transition_storage_class)
+        return transition
+
+    def add(self):
+        parser = argparse.ArgumentParser(
+            description='Add bucket lifecycle configuration',
+            usage='obo bucket lifecycle add <bucket>')
+        parser.add_argument('bucket_name')
+        self._add_rule_parser_args(parser)
+        args = parser.parse_args(self.args[1:])
+
+        assert args.enable != args.disable
+
+        expiration = self._get_rule_expiration(args)
+        transition = self._get_rule_transition(args)
 
         OboBucket(self.obo, args, args.bucket_name, True).add_lifecycle(args.id, args.prefix,
                 args.enable, expiration, transition)
 
+    def simulate(self):
+        parser = argparse.ArgumentParser(
+            description='Evaluate the impact of bucket lifecycle rules',
+            usage='obo bucket lifecycle simulate <bucket> [<proposed rule args>]')
+        parser.add_argument('bucket_name')
+        self._add_rule_parser_args(parser)
+        parser.add_argument('--batch-size', type=int, default=100000)
+        parser.add_argument('--window-days', type=int, default=30)
+        args = parser.parse_args(self.args[1:])
+
+        proposed = None
+        if args.id or args.prefix or args.expiration_days or args.expiration_date or args.transition_storage_class:
+            status = 'Disabled' if args.disable else 'Enabled'
+            proposed = boto.s3.lifecycle.Rule(args.id, args.prefix, status,
+                    self._get_rule_expiration(args), self._get_rule_transition(args))
+
+        print dump_json(OboBucket(self.obo, args, args.bucket_name, True).simulate_lifecycle(proposed, args.batch_size, args.window_days))
+
     def remove(self):
         parser = argparse.ArgumentParser(
             description='Delete bucket lifecycle configuration',
@@ -723,7 +2623,7 @@ The subcommands are:
         elif args.delete:
             OboBucket(self.obo, args, args.bucket_name, True).delete_website()
         else:
-            OboBucket(self.obo, args, args.bucket_name, True).get_website()
+            print dump_json(OboBucket(self.obo, args, args.bucket_name, True).get_website())
 
     def lifecycle(self):
         cmd = OboBucketLifecycleCommand(self.obo, sys.argv[3:]).parse()
@@ -746,19 +2646,28 @@ The commands are:
    getacl <bucket>[/<key>]       Get object ACL
    create <bucket>               Create a bucket
    stat <bucket>                 Get bucket info
+   du <bucket>[/<prefix>]        Get storage usage per prefix
    get <bucket>/<obj>            Get object
    put <bucket>/<obj>            Put object
    delete <bucket>[/<key>]       Delete bucket or key
+   purge-versions <bucket>       Delete noncurrent versions and stale delete markers
    copy <source> <target>        Copies an object
+   diff <source> <target>        Compare buckets or prefixes
+   rgwx-replay <file>            Replay a log of rgwx operations
    bucket versioning <bucket>    Enable/disable bucket versioning
    bucket lifecycle <...>        Manage bucket lifecycle
    bucket location get <...>     Read bucket location
    bucket website <...>          Manage bucket website
+
+All commands accept --profile <file> to write cProfile output of the run.
+Only the main thread is profiled, work done on thread pools (du, diff,
+put --from-dir, get --prefix) does not show up.
 ''')
         parser.add_argument('command', help='Subcommand to run')
         # parse_args defaults to [1:] for args, but you need to
         # exclude the rest of the args too, or validation will fail
         args = parser.parse_args(sys.argv[1:2])
+        args.command = args.command.replace('-', '_')
         if not hasattr(self, args.command) or args.command[0] == '_':
             print 'Unrecognized command:', args.command
             parser.print_help()
@@ -767,9 +2676,14 @@ The commands are:
         ret = getattr(self, args.command)
         access_key = os.environ['S3_ACCESS_KEY_ID']
         secret_key = os.environ['S3_SECRET_ACCESS_KEY']
-        host = os.environ['S3_HOSTNAME']
+        host = get_endpoints(os.environ)
+
+        scheduler = None
+        limits = get_scheduler_limits(os.environ)
+        if limits or os.environ.get('S3_TRANSFER_STATS'):
+            scheduler = OboTransferScheduler(limits)
 
-        self.obo = OBO(access_key, secret_key, host)
+        self.obo = OBO(access_key, secret_key, host, scheduler=scheduler)
         return ret
 
     def _add_rgwx_parser_args(self, parser):
@@ -807,9 +2721,13 @@ The commands are:
         args = parser.parse_args(sys.argv[2:])
 
         if not args.bucket_name:
-            OboService(self.obo, args).list_buckets()
+            print dump_json(list(OboService(self.obo, args).list_buckets()))
         else:
-            OboBucket(self.obo, args, args.bucket_name, True).list_objects()
+            l = OboBucket(self.obo, args, args.bucket_name, True).list_objects(prefix=args.prefix,
+                    delimiter=args.delimiter, marker=args.marker, max_keys=args.max_keys,
+                    versions=args.list_versions, key_marker=args.key_marker,
+                    version_id_marker=args.version_id_marker)
+            print dump_json(list(l))
 
     def create(self):
         parser = argparse.ArgumentParser(
@@ -834,22 +2752,62 @@ The commands are:
 
         obj = target[1] if len(target) == 2 else None
 
-        OboBucket(self.obo, args, target[0], True).stat(obj)
+        print dump_json(OboBucket(self.obo, args, target[0], True).stat(obj))
+
+    def du(self):
+        parser = argparse.ArgumentParser(
+            description='Get storage usage per prefix',
+            usage='obo du <bucket_name>[/<prefix>] [<args>]')
+        parser.add_argument('target', help='Target of operation: <bucket>[/<prefix>]')
+        parser.add_argument('--depth', type=int, default=0)
+        parser.add_argument('--delimiter', default='/')
+        parser.add_argument('--versions', action='store_true')
+        parser.add_argument('--num-threads', type=int, default=16)
+        args = parser.parse_args(sys.argv[2:])
+
+        target = args.target.split('/', 1)
+
+        prefix = target[1] if len(target) == 2 else ''
+
+        print dump_json(OboBucket(self.obo, args, target[0], True).du(prefix, args.depth, args.delimiter, args.versions, args.num_threads))
 
     def get(self):
         parser = argparse.ArgumentParser(
             description='Get object',
-            usage='obo get <bucket_name>/<key> [<args>]')
+            usage='''obo get <bucket_name>/<key> [<args>]
+       obo get <bucket_name> --prefix <prefix> --dest <dir> [<args>]''')
         parser.add_argument('source')
         parser.add_argument('--version-id')
         parser.add_argument('--if-modified-since')
         parser.add_argument('--if-unmodified-since')
         parser.add_argument('--date')
         parser.add_argument('-o', '--out-file')
+        parser.add_argument('--no-decompress', action='store_true', help='Do not decode according to Content-Encoding')
+        parser.add_argument('--cache', action='store_true', help='Use the local content cache')
+        parser.add_argument('--cache-dir', default=os.environ.get('S3_CACHE_DIR', os.path.expanduser('~/.cache/obo')))
+        parser.add_argument('--cache-size', type=int, default=1024*1024*1024, help='Cache size limit in bytes')
+        parser.add_argument('--cache-ttl', type=float, help='Serve cached objects without revalidation for this many seconds')
+        parser.add_argument('--cache-stats', action='store_true', help='Print cache hit/miss counters to stderr')
+        parser.add_argument('--read-ahead', type=int, default=0, help='Number of ranges to fetch ahead of the output')
+        parser.add_argument('--range-size', type=int, default=8*1024*1024, help='Range size for --read-ahead')
+        parser.add_argument('--prefix', help='Download all objects under prefix, requires --dest')
+        parser.add_argument('--dest', help='Destination directory for --prefix')
+        parser.add_argument('--part-size', type=int, default=16*1024*1024, help='Range size for --prefix downloads')
+        parser.add_argument('--num-threads', type=int, default=16)
+        parser.add_argument('--check-etag', action='store_true', help='Compare MD5 of existing files to ETag before skipping')
         args = parser.parse_args(sys.argv[2:])
 
         target = args.source.split('/', 1)
 
+        if args.prefix is not None or args.dest is not None:
+            if args.prefix is None or args.dest is None:
+                raise OBOException('--prefix and --dest need to be used together')
+            bucket = OboBucket(self.obo, args, target[0], True)
+            for r in bucket.get_prefix(args.prefix, args.dest, args.part_size, args.num_threads, args.check_etag):
+                print json.dumps(r)
+                sys.stdout.flush()
+            return
+
         assert len(target) == 2
 
         OboBucket(self.obo, args, target[0], True).get(target[1])
@@ -865,18 +2823,29 @@ The commands are:
         target = args.source.split('/', 1)
         obj = target[1] if len(target) == 2 else ''
 
-        OboBucket(self.obo, args, target[0], True).getacl(obj)
+        acl = OboBucket(self.obo, args, target[0], True).getacl(obj, args.version_id)
+        # TODO include a better format option for importing back
+        print acl
 
     def put(self):
         parser = argparse.ArgumentParser(
             description='Put object',
-            usage='obo put <bucket_name>/<key> [<args>]')
+            usage='''obo put <bucket_name>/<key> [<args>]
+       obo put <bucket_name> --from-dir <dir> | --from-list <file> [--prefix <prefix>] [<args>]''')
         parser.add_argument('target')
         parser.add_argument('-i', '--in-file')
+        parser.add_argument('--from-dir', help='Upload all files under directory')
+        parser.add_argument('--from-list', help='Upload files listed in file, one path per line (- for stdin)')
+        parser.add_argument('--prefix', default='', help='Key prefix for --from-dir/--from-list')
+        parser.add_argument('--num-threads', type=int, default=32)
         parser.add_argument('--canned-acl')
         parser.add_argument('--content-type')
         parser.add_argument('--multipart', action='store_true')
-        parser.add_argument('--part_size', type=int, default=8*1024*1024)
+        parser.add_argument('--part_size', type=part_size_arg, default=8*1024*1024,
+                            help='Part size in bytes, or \'auto\' to pick it from the file size')
+        parser.add_argument('--max-concurrency', type=int, default=16,
+                            help='Maximum number of parts in flight with --part_size=auto')
+        parser.add_argument('--compress', choices=COMPRESSION_TYPES)
         parser.add_argument('--storage-class')
         parser.add_argument('--x-amz-meta', nargs='*')
         self._add_rgwx_parser_args(parser)
@@ -895,6 +2864,23 @@ The commands are:
 
         rgwx_query_args = self._get_rgwx_query_args(args)
 
+        if args.from_dir or args.from_list:
+            if args.compress or args.multipart or args.in_file:
+                raise OBOException('--from-dir/--from-list cannot be used with --in-file, --compress or --multipart')
+
+            if args.from_dir:
+                files = walk_dir(args.from_dir, args.prefix)
+            elif args.from_list == '-':
+                files = read_file_list(sys.stdin, args.prefix)
+            else:
+                files = read_file_list(open(args.from_list), args.prefix)
+
+            bucket = OboBucket(self.obo, args, target[0], True, query_args=rgwx_query_args)
+            for r in bucket.put_files(files, x_amz_meta, args.num_threads):
+                print json.dumps(r)
+                sys.stdout.flush()
+            return
+
         assert len(target) == 2
 
         OboBucket(self.obo, args, target[0], True, query_args=rgwx_query_args).put(target[1], x_amz_meta)
@@ -925,6 +2911,40 @@ The commands are:
             assert len(target) == 2
             OboObject(self.obo, args, target[0], target[1], query_args=rgwx_query_args).remove(args.version_id, args.if_unmodified_since, mfa=mfa)
 
+    def purge_versions(self):
+        parser = argparse.ArgumentParser(
+            description='Delete noncurrent object versions and stale delete markers',
+            usage='obo purge-versions <bucket_name> [<args>]')
+        parser.add_argument('bucket_name')
+        parser.add_argument('--prefix', default='')
+        parser.add_argument('--keep', type=int, default=0, help='Number of noncurrent versions to keep per key')
+        parser.add_argument('--older-than', type=int, help='Only purge versions noncurrent for more than this many days')
+        parser.add_argument('--key-marker')
+        parser.add_argument('--version-id-marker')
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--mfa-id')
+        parser.add_argument('--mfa-token')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--num-threads', type=int, default=8)
+        args = parser.parse_args(sys.argv[2:])
+
+        mfa = None
+        if args.mfa_id:
+            mfa = (args.mfa_id, args.mfa_token)
+
+        older_than = None
+        if args.older_than is not None:
+            older_than = time.time() - args.older_than * SECONDS_PER_DAY
+
+        on_select = None
+        if args.dry_run:
+            on_select = lambda r: sys.stdout.write(json.dumps(r) + '\n')
+
+        summary = OboBucket(self.obo, args, args.bucket_name, True).purge_versions(args.prefix, args.keep, older_than, mfa,
+                args.dry_run, min(args.batch_size, 1000), args.num_threads,
+                key_marker=args.key_marker, version_id_marker=args.version_id_marker, on_select=on_select)
+        print dump_json(summary)
+
     def copy(self):
         parser = argparse.ArgumentParser(
             description='Copies an object',
@@ -948,6 +2968,48 @@ The commands are:
         else:
             OboObject(self.obo, args, target[0], target[1], query_args=rgwx_query_args).replace(source, args.version_id)
 
+    def diff(self):
+        parser = argparse.ArgumentParser(
+            description='Compare two buckets or prefixes',
+            usage='obo diff <bucket_name>[/<prefix>] <bucket_name>[/<prefix>] [<args>]')
+        parser.add_argument('source')
+        parser.add_argument('target')
+        parser.add_argument('--compare', default='size,etag',
+                            help='Comma separated fields to compare: ' + ','.join(DIFF_FIELDS))
+        parser.add_argument('--delimiter', default='/', help='Delimiter used to split the keyspace into shards')
+        parser.add_argument('--num-threads', type=int, default=16)
+        args = parser.parse_args(sys.argv[2:])
+
+        compare = args.compare.split(',')
+        for c in compare:
+            if c not in DIFF_FIELDS:
+                raise OBOException('unknown compare field: ' + c)
+
+        source = args.source.split('/', 1) + ['']
+        target = args.target.split('/', 1) + ['']
+
+        src = OboBucket(self.obo, args, source[0], True)
+        dst = OboBucket(self.obo, args, target[0], True)
+
+        for r in OboDiff(src.bucket, source[1], dst.bucket, target[1], compare).diff(args.num_threads, args.delimiter):
+            print json.dumps(r)
+            sys.stdout.flush()
+
+    def rgwx_replay(self):
+        parser = argparse.ArgumentParser(
+            description='Replay a log of copy, put and delete operations with their rgwx params',
+            usage='obo rgwx-replay <file> [<args>]')
+        parser.add_argument('log_file', help='Log of operations, one JSON object per line (- for stdin)')
+        parser.add_argument('--rate', type=float, help='Target rate in ops/s (default: unlimited)')
+        parser.add_argument('--num-lanes', type=int, default=32, help='Number of concurrent lanes')
+        parser.add_argument('--storage-class')
+        self._add_rgwx_parser_args(parser)
+        args = parser.parse_args(sys.argv[2:])
+
+        log = sys.stdin if args.log_file == '-' else open(args.log_file)
+
+        print dump_json(OboRgwxReplay(self.obo, args).replay(log, self._get_rgwx_query_args, args.rate, args.num_lanes))
+
     def mdsearch(self):
         parser = argparse.ArgumentParser(
             description='Performs metadata search',
@@ -965,19 +3027,47 @@ The commands are:
         rgwx_query_args = self._get_rgwx_query_args(args)
 
         if args.config is not None or args.delete:
-            OboMDSearch(self.obo, args, args.bucket, args.query, query_args=rgwx_query_args).config(args.config)
+            OboMDSearch(self.obo, args, args.bucket, args.query, query_args=rgwx_query_args).config(args.config, args.delete)
         elif args.show:
-            OboMDSearch(self.obo, args, args.bucket, args.query, query_args=rgwx_query_args).show()
+            print dump_json(OboMDSearch(self.obo, args, args.bucket, args.query, query_args=rgwx_query_args).show())
         else:
-            OboMDSearch(self.obo, args, args.bucket, args.query, query_args=rgwx_query_args).search()
+            print dump_json(list(OboMDSearch(self.obo, args, args.bucket, args.query, query_args=rgwx_query_args).search()))
 
 
     def bucket(self):
         cmd = OboBucketCommand(self.obo, sys.argv[2:]).parse()
         cmd()
 
+def pop_profile_arg(argv):
+    # --profile is accepted by every command, so it is taken out before the
+    # command parses its own args
+    for i, a in enumerate(argv):
+        if a == '--profile' and i + 1 < len(argv):
+            path = argv[i + 1]
+            del argv[i:i + 2]
+            return path
+        if a.startswith('--profile='):
+            del argv[i]
+            return a.split('=', 1)[1]
+    return None
+
 def main():
-    cmd = OboCommand()._parse()
+    profile_file = pop_profile_arg(sys.argv)
+    profiler = None
+    if profile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        run_command()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+
+def run_command():
+    obo_cmd = OboCommand()
+    cmd = obo_cmd._parse()
     try:
         cmd()
     except boto.exception.S3ResponseError as e:
@@ -992,3 +3082,8 @@ def main():
     except OBOException as e:
         print'ERROR: ' + e.message
 
+    if os.environ.get('S3_TRANSFER_STATS') and obo_cmd.obo.scheduler:
+        sys.stderr.write(dump_json(obo_cmd.obo.scheduler.get_stats()) + '\n')
+
+    if os.environ.get('S3_ENDPOINT_STATS') and obo_cmd.obo.balancer:
+        sys.stderr.write(dump_json(obo_cmd.obo.balancer.get_stats()) + '\n')